@@ -1,22 +1,23 @@
 import streamlit as st
 import os
+import io
+import hashlib
+import threading
+import time
+import queue
 import asyncio
 import logging
-import nest_asyncio
-import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from PIL import Image
+from pydantic import BaseModel, ValidationError
 
 # Standard GenAI Library
 from google import genai
-from google.genai import types
-
-# Keep ADK structure for Definitions
-from google.adk.agents import LlmAgent
-from google.adk.models.google_llm import Gemini
+from google.genai import errors, types
 
 # 1. SETUP
-nest_asyncio.apply()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("Mythmaker_Runner")
 
@@ -26,119 +27,343 @@ if not api_key:
     st.error("Missing GOOGLE_API_KEY in .env")
     st.stop()
 
-# Initialize the Standard Client
-client = genai.Client(api_key=api_key)
+# Initialize the Standard Client (once per process, shared across sessions)
+@st.cache_resource
+def get_client():
+    return genai.Client(api_key=api_key)
+
+# Structured verdict returned by the Critic
+class CriticResult(BaseModel):
+    score: int
+    feedback: str
+
+# Visual details + first draft returned by the fused Visionary/Bard call
+class FusedResult(BaseModel):
+    visuals: list[str]
+    myth: str
 
 # 2. DEFINE AGENTS (Blueprints)
+DEFAULT_MODEL = "gemini-2.5-pro"
 
-# Visionary: Sees the image
-visionary_agent = LlmAgent(
-    model=Gemini(model_name="gemini-2.5-pro", api_key=api_key),
-    name="Visionary",
-    instruction="You are The Visionary. Analyze images and list 3 specific, vivid visual details that look spooky or mysterious."
-)
-
-# Investigator: Searches REAL history
-investigator_agent = LlmAgent(
-    model=Gemini(model_name="gemini-2.5-pro", api_key=api_key),
-    name="Investigator",
-    instruction=(
-        "You are The Investigator. You MUST use Google Search to find verified historical facts. "
-        "Focus on: dark history, crimes, local legends, and specific dates. "
-        "Do NOT make up facts. If you can't find info, state that."
-    )
-)
-
-# Bard: Writes the story
-mythmaker_agent = LlmAgent(
-    model=Gemini(model_name="gemini-2.5-pro", api_key=api_key),
-    name="Bard",
-    instruction="You are The Local Mythmaker. Write a short 'Micro-Myth' (max 120 words) weaving verified history into a spooky narrative and first person to the user."
-)
-
-# Critic: Evaluates quality
-critic_agent = LlmAgent(
-    model=Gemini(model_name="gemini-2.5-pro", api_key=api_key),
-    name="Critic",
-    instruction=(
-        "You are the Editor. Evaluate the myth for spookiness and historical accuracy integration. "
-        "Return ONLY a JSON object: {'score': int (1-10), 'feedback': 'string'}. "
-        "Do not output markdown."
-    )
-)
+@dataclass(frozen=True)
+class Agent:
+    name: str
+    instruction: str
+    model: str = DEFAULT_MODEL
+
+@st.cache_resource
+def get_agents():
+    return {
+        # Visionary: Sees the image
+        "visionary": Agent(
+            name="Visionary",
+            instruction="You are The Visionary. Analyze images and list 3 specific, vivid visual details that look spooky or mysterious."
+        ),
+
+        # Investigator: Searches REAL history
+        "investigator": Agent(
+            name="Investigator",
+            instruction=(
+                "You are The Investigator. You MUST use Google Search to find verified historical facts. "
+                "Focus on: dark history, crimes, local legends, and specific dates. "
+                "Do NOT make up facts. If you can't find info, state that."
+            )
+        ),
+
+        # Bard: Writes the story
+        "mythmaker": Agent(
+            name="Bard",
+            instruction="You are The Local Mythmaker. Write a short 'Micro-Myth' (max 120 words) weaving verified history into a spooky narrative and first person to the user."
+        ),
+
+        # Critic: Evaluates quality
+        "critic": Agent(
+            name="Critic",
+            instruction=(
+                "You are the Editor. Evaluate the myth for spookiness and historical accuracy integration. "
+                "Return ONLY a JSON object: {'score': int (1-10), 'feedback': 'string'}. "
+                "Do not output markdown."
+            ),
+            # Flash is plenty for a short JSON verdict
+            model="gemini-2.5-flash"
+        ),
+
+        # Seer: Visionary + Bard in one multimodal call (used when lore arrives early)
+        "fused": Agent(
+            name="Seer",
+            instruction=(
+                "You are The Visionary and The Local Mythmaker at once. "
+                "First list 3 specific, vivid visual details in the image that look spooky or mysterious. "
+                "Then write a short 'Micro-Myth' (max 120 words) weaving those details and the verified history "
+                "into a spooky narrative and first person to the user. "
+                "Return ONLY a JSON object: {'visuals': ['string'], 'myth': 'string'}."
+            )
+        ),
+    }
+
+# Shared worker pool for the remaining blocking calls, sized for I/O concurrency
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=int(os.getenv("THREAD_POOL_SIZE", "64")))
+
+# Cross-session cap on in-flight Gemini calls (all sessions share the one loop)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+
+# How long to wait for lore before giving up on the fused Visionary + Bard call
+FUSION_LORE_TIMEOUT = float(os.getenv("FUSION_LORE_TIMEOUT", "1.0"))
+
+# One long-lived event loop on a daemon thread drives every async Gemini call,
+# so the cached client's async HTTP pool is only ever used from the loop it is bound to
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="gemini-loop", daemon=True).start()
+    return loop
+
+client = get_client()
+agents = get_agents()
+gemini_loop = get_event_loop()
 
 # 3. ORCHESTRATION & RUNNER
 
-async def run_pipeline(image_bytes, mime_type, location):
-    session_memory = {
-        "visuals": "",
-        "lore": "",
-        "drafts": [],
-        "final_myth": ""
+# --- GENERATION CONFIGS (built once per agent) ---
+def build_config(agent, use_google_search=False, response_schema=None):
+    # 1. Config System Instruction
+    config = types.GenerateContentConfig(
+        system_instruction=agent.instruction,
+        temperature=0.7
+    )
+
+    # 2. Enable Real Google Search if requested
+    if use_google_search:
+        # This enables the built-in Gemini Search Tool
+        config.tools = [types.Tool(google_search=types.GoogleSearch())]
+        config.automatic_function_calling = types.AutomaticFunctionCallingConfig(disable=False)
+
+    # 3. Constrain output to JSON matching the schema if requested
+    if response_schema:
+        config.response_mime_type = "application/json"
+        config.response_schema = response_schema
+
+    return config
+
+@st.cache_resource
+def get_agent_configs():
+    return {
+        agents["visionary"].name: build_config(agents["visionary"]),
+        agents["investigator"].name: build_config(agents["investigator"], use_google_search=True),
+        agents["mythmaker"].name: build_config(agents["mythmaker"]),
+        agents["critic"].name: build_config(agents["critic"], response_schema=CriticResult),
+        agents["fused"].name: build_config(agents["fused"], response_schema=FusedResult),
     }
 
-    # --- UNIVERSAL RUNNER (With Real Tools) ---
-    def execute_agent(agent, prompt, image_input=None, use_google_search=False):
-        logger.info(f"⚡ Executing {agent.name}...")
-        
-        # 1. Config System Instruction
-        config = types.GenerateContentConfig(
-            system_instruction=agent.instruction,
-            temperature=0.7
-        )
-        
-        # 2. Enable Real Google Search if requested
-        if use_google_search:
-            # This enables the built-in Gemini Search Tool
-            config.tools = [types.Tool(google_search=types.GoogleSearch())]
-            config.automatic_function_calling = types.AutomaticFunctionCallingConfig(disable=False)
-
-        # 3. Prepare Content
-        content = []
-        if image_input:
-            content.append(types.Part.from_bytes(data=image_input, mime_type=mime_type))
-        content.append(prompt)
-
-        # 4. Execute via Standard Client
+agent_configs = get_agent_configs()
+
+# execute_agent reports failures as text rather than raising
+NO_RESPONSE = "No response generated."
+
+def is_failure(text):
+    return not text or text == NO_RESPONSE or text.startswith("Error:")
+
+class LoreUnavailable(Exception):
+    pass
+
+@st.cache_resource
+def get_gemini_slots():
+    return asyncio.BoundedSemaphore(GEMINI_CONCURRENCY)
+
+gemini_slots = get_gemini_slots()
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, gemini_loop)
+
+# --- UNIVERSAL RUNNER (With Real Tools) ---
+async def execute_agent(agent, prompt, image_part=None, on_chunk=None):
+    logger.info(f"⚡ Executing {agent.name}...")
+    config = agent_configs[agent.name]
+
+    # 1. Prepare Content
+    content = []
+    if image_part:
+        content.append(image_part)
+    content.append(prompt)
+
+    # 2. Execute via Standard Client (throttled, retrying on rate limits)
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
         try:
-            response = client.models.generate_content(
-                model="gemini-2.5-pro",
-                contents=content,
-                config=config
-            )
-            
+            async with gemini_slots:
+                if on_chunk:
+                    # Stream tokens so the caller can render text as it arrives
+                    full_text = ""
+                    async for chunk in await client.aio.models.generate_content_stream(
+                        model=agent.model,
+                        contents=content,
+                        config=config
+                    ):
+                        if chunk.text:
+                            full_text += chunk.text
+                            on_chunk(full_text)
+                    return full_text if full_text else NO_RESPONSE
+
+                response = await client.aio.models.generate_content(
+                    model=agent.model,
+                    contents=content,
+                    config=config
+                )
+
             # Extract text carefully (Grounding metadata can sometimes split parts)
             full_text = ""
             if response.candidates and response.candidates[0].content.parts:
-                for part in response.candidates[0].content.parts:
-                    if part.text:
-                        full_text += part.text
-            return full_text if full_text else "No response generated."
+                full_text = "".join(
+                    part.text for part in response.candidates[0].content.parts if part.text
+                )
+            return full_text if full_text else NO_RESPONSE
+
+        except errors.APIError as e:
+            if e.code == 429 and attempt < GEMINI_MAX_RETRIES:
+                delay = 2 ** attempt
+                logger.warning(f"Agent {agent.name} rate limited, retrying in {delay}s...")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"Agent {agent.name} failed: {e}")
+            return f"Error: {str(e)}"
 
         except Exception as e:
             logger.error(f"Agent {agent.name} failed: {e}")
             return f"Error: {str(e)}"
 
+# Lore depends only on the location, so cache it independently of the image.
+# st.cache_data needs a sync function, so a worker thread waits on the shared loop.
+# Failures raise so they are never cached.
+@st.cache_data(show_spinner=False, ttl=86400, max_entries=512)
+def fetch_lore(location):
+    lore = run_async(execute_agent(
+        agents["investigator"],
+        f"Find specific dark history and ghost stories for: {location}"
+    )).result()
+    if is_failure(lore):
+        raise LoreUnavailable(f"Investigator found no lore for {location!r}: {lore}")
+    return lore
+
+LORE_UNAVAILABLE = "No verified lore could be retrieved for this location."
+
+async def await_lore(investigator_task):
+    try:
+        return await investigator_task
+    except LoreUnavailable as e:
+        logger.warning(f"{e}; continuing without verified lore.")
+        return None
+
+# --- ECONOMY MODE (Batch API: ~half the cost, minutes instead of seconds) ---
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "5"))
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", "600"))
+
+async def batch_generate(agent, prompts):
+    logger.info(f"⚡ Batching {len(prompts)} requests for {agent.name}...")
+    try:
+        job = await client.aio.batches.create(
+            model=agent.model,
+            src=[types.InlinedRequest(contents=prompt, config=agent_configs[agent.name]) for prompt in prompts]
+        )
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        while job.state.name not in BATCH_DONE_STATES:
+            if time.monotonic() > deadline:
+                logger.warning(f"Batch {job.name} timed out, cancelling.")
+                await client.aio.batches.cancel(name=job.name)
+                return None
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            job = await client.aio.batches.get(name=job.name)
+
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            logger.warning(f"Batch {job.name} ended in {job.state.name}.")
+            return None
+        return [
+            item.response.text if item.response and item.response.text else NO_RESPONSE
+            for item in job.dest.inlined_responses
+        ]
+
+    except Exception as e:
+        logger.error(f"Batch for {agent.name} failed: {e}")
+        return None
+
+# Critic score; an unparseable verdict counts as a fail so the draft still gets refined
+def critic_score(eval_result):
+    try:
+        return CriticResult.model_validate_json(eval_result).score
+    except ValidationError as e:
+        logger.warning(f"Critic parse failed: {e}; raw={eval_result[:200]!r}")
+        return 0
+
+POLISH_NOTES = "sharpen the imagery, heighten the dread and tighten the prose"
+
+async def run_pipeline(image_bytes, mime_type, location, on_draft=None, economy=False):
+    session_memory = {
+        "visuals": "",
+        "lore": "",
+        "drafts": [],
+        "final_myth": ""
+    }
+
+    # Build the image Part once; every image-consuming call reuses it
+    image_part = types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+
     # --- PHASE 1: PARALLEL GATHERING ---
     logger.info("--- Phase 1: Parallel ---")
     
-    # Task A: Vision
-    vision_task = asyncio.to_thread(
-        execute_agent, 
-        visionary_agent, 
-        "Describe the atmosphere.", 
-        image_input=image_bytes
-    )
+    # Task A: Vision (starts right away; dropped if the fused call takes over)
+    def describe_image():
+        return asyncio.create_task(execute_agent(
+            agents["visionary"], 
+            "Describe the atmosphere.", 
+            image_part=image_part
+        ))
+
+    vision_task = describe_image()
     
     # Task B: Investigation (NOW WITH REAL SEARCH)
-    investigator_task = asyncio.to_thread(
-        execute_agent,
-        investigator_agent,
-        f"Find specific dark history and ghost stories for: {location}",
-        use_google_search=True 
+    investigator_task = asyncio.get_running_loop().run_in_executor(
+        get_executor(), fetch_lore, location
     )
-    
-    visuals, lore = await asyncio.gather(vision_task, investigator_task)
+
+    current_draft = None
+
+    try:
+        # Fast path: lore is already at hand (e.g. cached), so one multimodal call
+        # both reads the image and writes the first draft
+        done, _ = await asyncio.wait({investigator_task}, timeout=FUSION_LORE_TIMEOUT)
+        lore = await await_lore(investigator_task) if done else None
+        if lore is not None:
+            logger.info("--- Phase 1b: Fused Vision + Draft ---")
+            # The fused call reads the image itself; don't pay for a second image call
+            vision_task.cancel()
+            fused_result = await execute_agent(
+                agents["fused"],
+                f"Describe the atmosphere and write the myth.\n\nCONTEXT:\nLOCATION: {location}\nVERIFIED LORE: {lore}\n",
+                image_part=image_part
+            )
+            try:
+                fused = FusedResult.model_validate_json(fused_result)
+                visuals = "\n".join(f"- {detail}" for detail in fused.visuals)
+                current_draft = fused.myth
+                if on_draft:
+                    on_draft(current_draft)
+            except ValidationError:
+                logger.warning("Fused call returned no usable JSON, falling back to Visionary + Bard.")
+                vision_task = describe_image()
+
+        if current_draft is None:
+            if done:
+                visuals = await vision_task
+            else:
+                visuals, lore = await asyncio.gather(vision_task, await_lore(investigator_task))
+            lore = lore or LORE_UNAVAILABLE
+    finally:
+        # A failed or cancelled run must not leave the Visionary running
+        if not vision_task.done():
+            vision_task.cancel()
     
     session_memory["visuals"] = visuals
     session_memory["lore"] = lore
@@ -150,44 +375,175 @@ async def run_pipeline(image_bytes, mime_type, location):
         f"VERIFIED LORE: {lore}\n"
     )
 
-    # --- PHASE 3: LOOP & EVALUATION ---
-    logger.info("--- Phase 3: Loop ---")
-    
-    current_draft = ""
-    feedback = ""
+    # --- PHASE 3 (ECONOMY): BATCHED DRAFTS, CRITIC PICKS THE BEST ---
+    if economy:
+        logger.info("--- Phase 3: Economy Batch ---")
+        prompts = [f"Write the myth. Then {POLISH_NOTES}.\n\nCONTEXT:\n{context_package}"]
+        if current_draft is None:
+            prompts.insert(0, f"Write the myth.\n\nCONTEXT:\n{context_package}")
+
+        batched = await batch_generate(agents["mythmaker"], prompts) or []
+        drafts = ([current_draft] if current_draft is not None else []) + batched
+        session_memory["drafts"].extend(drafts)
+
+        # Only usable drafts go to the Critic; otherwise fall back to the interactive path
+        candidates = [draft for draft in drafts if not is_failure(draft)]
+        if candidates:
+            verdicts = await asyncio.gather(*(
+                execute_agent(agents["critic"], f"Evaluate:\n{draft}") for draft in candidates
+            ))
+            scores = [critic_score(verdict) for verdict in verdicts]
+            session_memory["final_myth"] = candidates[scores.index(max(scores))]
+            return session_memory
+
+        logger.warning("Economy batch produced no usable drafts, falling back to interactive drafts.")
+        current_draft = None  # Every candidate failed, so draft again from scratch
+
+    # --- PHASE 3: DRAFT, EVALUATION & SPECULATIVE REFINEMENT ---
+    logger.info("--- Phase 3: Draft & Refine ---")
     
-    for i in range(2): 
-        # 3a. Generate
-        prompt_text = "Write the myth."
-        if feedback:
-            prompt_text = f"Refine this myth based on feedback: {feedback}"
-            
-        full_prompt = f"{prompt_text}\n\nCONTEXT:\n{context_package}"
-        
-        current_draft = await asyncio.to_thread(
-            execute_agent, mythmaker_agent, full_prompt
-        )
+    critic_task = refine_task = None
+    try:
+        # 3a. Generate (already done on the fused path)
+        if current_draft is None:
+            full_prompt = f"Write the myth.\n\nCONTEXT:\n{context_package}"
+            current_draft = await execute_agent(agents["mythmaker"], full_prompt, on_chunk=on_draft)
         session_memory["drafts"].append(current_draft)
 
-        # 3b. Critic Evaluate
-        eval_result = await asyncio.to_thread(
-            execute_agent, critic_agent, f"Evaluate:\n{current_draft}"
+        # 3b. Critic Evaluate + speculative refinement in parallel
+        critic_task = asyncio.create_task(
+            execute_agent(agents["critic"], f"Evaluate:\n{current_draft}")
         )
-        
-        try:
-            clean_json = eval_result.replace("```json", "").replace("```", "").strip()
-            data = json.loads(clean_json)
-            score = data.get("score", 0)
-            feedback = data.get("feedback", "Good.")
-            
-            if score >= 8:
-                break
-        except:
-            break
+        refine_prompt = (
+            f"Refine this myth: {POLISH_NOTES}.\n\n"
+            f"DRAFT:\n{current_draft}\n\nCONTEXT:\n{context_package}"
+        )
+        refine_task = asyncio.create_task(
+            execute_agent(agents["mythmaker"], refine_prompt)
+        )
+
+        eval_result = await critic_task
+
+        score = critic_score(eval_result)
+
+        if score >= 8:
+            # Draft already passes; discard the speculative rewrite
+            refine_task.cancel()
+        else:
+            refined = await refine_task
+            session_memory["drafts"].append(refined)
+            # A failed rewrite must not discard a usable first draft
+            if not is_failure(refined):
+                current_draft = refined
+
+    finally:
+        # Runs on success, error and cancellation alike, so nothing outlives the run
+        for task in (critic_task, refine_task):
+            if task and not task.done():
+                task.cancel()
 
     session_memory["final_myth"] = current_draft
     return session_memory
 
+# Response cache: identical image + location skips the whole pipeline.
+# Only finished results are cached (shared across sessions), so the live draft
+# preview stays outside any st.cache_data function.
+MYTH_CACHE_TTL = 3600
+MYTH_CACHE_MAX_ENTRIES = 128
+
+@st.cache_resource
+def get_myth_cache():
+    return OrderedDict(), threading.Lock()
+
+def cached_myth(key):
+    entries, lock = get_myth_cache()
+    with lock:
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        stored_at, memory = entry
+        if time.monotonic() - stored_at > MYTH_CACHE_TTL:
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return memory
+
+def store_myth(key, memory):
+    entries, lock = get_myth_cache()
+    with lock:
+        entries[key] = (time.monotonic(), memory)
+        entries.move_to_end(key)
+        while len(entries) > MYTH_CACHE_MAX_ENTRIES:
+            entries.popitem(last=False)
+
+# Render the most recent queued draft, if any
+def flush_drafts(drafts, on_draft):
+    latest = None
+    while not drafts.empty():
+        latest = drafts.get()
+    if latest is not None and on_draft:
+        on_draft(latest)
+
+# A run is only reusable if every stage produced real output
+def run_succeeded(memory):
+    return not (
+        is_failure(memory["visuals"])
+        or is_failure(memory["final_myth"])
+        or memory["lore"] == LORE_UNAVAILABLE
+    )
+
+def summon_myth(image_bytes, mime_type, location, economy=False, on_draft=None, on_wait=None):
+    key = f"{hashlib.sha256(image_bytes).hexdigest()}|{mime_type}|{location}|{economy}"
+    memory = cached_myth(key)
+    if memory is None:
+        # The pipeline runs on the shared loop thread, which has no Streamlit
+        # context, so streamed drafts are queued and rendered from this thread
+        drafts = queue.SimpleQueue()
+        future = run_async(run_pipeline(
+            image_bytes, mime_type, location, on_draft=drafts.put if on_draft else None, economy=economy
+        ))
+        started = last_tick = time.monotonic()
+        try:
+            while not future.done():
+                time.sleep(0.1)
+                flush_drafts(drafts, on_draft)
+                # Streamlit only honours Stop/Rerun inside st.* calls, so tick
+                # the UI regularly even when nothing is streaming (e.g. batches)
+                if on_wait and time.monotonic() - last_tick >= 1:
+                    last_tick = time.monotonic()
+                    on_wait(last_tick - started)
+            flush_drafts(drafts, on_draft)
+            memory = future.result()
+        finally:
+            # Abandoned reruns (e.g. Streamlit stopping the script) cancel the pipeline
+            future.cancel()
+        if is_failure(memory["final_myth"]):
+            raise RuntimeError(f"The agents could not produce a myth: {memory['final_myth']}")
+        if run_succeeded(memory):
+            store_myth(key, memory)
+    return memory
+
+# Downscale uploads before they reach the Visionary (smaller payload, fewer vision tokens)
+@st.cache_data(show_spinner=False, max_entries=64)
+def compress_image(image_bytes, max_side=1024, quality=85):
+    from PIL import Image, ImageOps  # Deferred: only needed once an image is submitted
+
+    img = Image.open(io.BytesIO(image_bytes))
+    # Re-encoding drops EXIF, so bake the phone's Orientation tag into the pixels first
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    # JPEG has no alpha: flatten transparent areas onto white instead of black
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+
+    buffer = io.BytesIO()
+    img.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
 # 4. UI
 st.set_page_config(page_title="Mythmaker", layout="wide")
 
@@ -199,24 +555,43 @@ with col1:
 with col2:
     uploaded_file = st.file_uploader("Upload Artifact", type=["jpg", "png", "jpeg"])
 
+economy_mode = st.checkbox("Economy mode (slower, cheaper)", help="Drafts go through the Gemini Batch API at about half the cost; expect minutes, not seconds.")
+
 if st.button("Summon Agents"):
     if uploaded_file and location_input:
-        image_bytes = uploaded_file.getvalue()
-        mime_type = uploaded_file.type
-        display_image = Image.open(uploaded_file)
-        
-        with st.status("🔮 Agents are communing...", expanded=True) as status:
-            try:
-                memory = asyncio.run(run_pipeline(image_bytes, mime_type, location_input))
-                
-                st.session_state.memory = memory
-                st.session_state.analysis_complete = True
-                st.session_state.current_image = display_image
-                
-                status.update(label="Myth Manifested!", state="complete", expanded=False)
-            except Exception as e:
-                st.error(f"Error: {e}")
-                logger.exception("Trace:")
+        raw_bytes = uploaded_file.getvalue()
+        location = location_input.strip()
+        # Case-insensitive key for every cache; the original text is only for display
+        location_key = location.lower()
+        run_key = hashlib.sha256(raw_bytes + location_key.encode() + bytes([economy_mode])).hexdigest()
+
+        # Same inputs as the last run: reuse the persisted session memory
+        if st.session_state.get("last_key") == run_key and st.session_state.get("analysis_complete"):
+            logger.info("Inputs unchanged, reusing session memory.")
+        else:
+            image_bytes = compress_image(raw_bytes)
+            mime_type = "image/jpeg"
+            
+            with st.status("🔮 Agents are communing...", expanded=True) as status:
+                try:
+                    # Live preview of the first draft while the Bard writes it
+                    draft_preview = st.empty()
+                    memory = summon_myth(
+                        image_bytes, mime_type, location_key, economy=economy_mode, on_draft=draft_preview.markdown,
+                        on_wait=lambda elapsed: status.update(label=f"🔮 Agents are communing... ({elapsed:.0f}s)")
+                    )
+                    
+                    st.session_state.memory = memory
+                    st.session_state.analysis_complete = True
+                    st.session_state.current_image = raw_bytes
+                    st.session_state.location = location
+                    # Degraded runs (missing lore or visuals) stay retryable
+                    st.session_state.last_key = run_key if run_succeeded(memory) else None
+                    
+                    status.update(label="Myth Manifested!", state="complete", expanded=False)
+                except Exception as e:
+                    st.error(f"Error: {e}")
+                    logger.exception("Trace:")
 
 if "analysis_complete" in st.session_state and st.session_state.analysis_complete:
     st.divider()
@@ -226,7 +601,7 @@ if "analysis_complete" in st.session_state and st.session_state.analysis_complet
     with c1:
         st.image(st.session_state.current_image, caption="Analyzed Artifact", use_container_width=True)
     with c2:
-        st.subheader(f"The Myth of {location_input}")
+        st.subheader(f"The Myth of {st.session_state.location}")
         # Apply the custom CSS class
         st.markdown(f'<div class="myth-box">{mem.get("final_myth")}</div>', unsafe_allow_html=True)
     